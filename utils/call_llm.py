@@ -1,9 +1,28 @@
 from google import genai
 import os
+import sys
+import signal
+import asyncio
+import atexit
 import logging
+import logging.handlers
+import queue
 import json
+import sqlite3
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 
+# orjson is optional; it parses several times faster than the stdlib json module
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 """
 === LLM TOKEN COST LOGGING GUIDE ===
 
@@ -11,16 +30,20 @@ Token Pricing Configuration:
   - TOKEN_PRICING dict contains pricing for different models
   - Prices are per 1M tokens in USD
   - Override via environment variable: ANTHROPIC_TOKEN_PRICING (JSON format)
+  - Resolved once at import; call refresh_pricing() after changing it at runtime
 
 Available Models and Their Pricing:
-  - claude-haiku-4-5-20251001:    Input $0.80, Output $4.00, Thinking $0.30 per 1M tokens
-  - claude-3-5-sonnet-20241022:   Input $3.00, Output $15.00, Thinking $1.00 per 1M tokens
-  - claude-3-opus-20250219:       Input $15.00, Output $75.00, Thinking $5.00 per 1M tokens
+  - claude-haiku-4-5-20251001:    Input $0.80, Output $4.00 per 1M tokens
+  - claude-3-5-sonnet-20241022:   Input $3.00, Output $15.00 per 1M tokens
+  - claude-3-opus-20250219:       Input $15.00, Output $75.00 per 1M tokens
+  - Extended thinking is billed as output, so thinking tokens are part of OUTPUT
+  - Prompt cache writes cost 1.25x and reads 0.1x the input price unless
+    "cache_write" / "cache_read" are given
 
 Log Output Includes:
   ✓ Input tokens and cost
   ✓ Output tokens and cost
-  ✓ Thinking tokens and cost (for extended thinking models)
+  ✓ Prompt cache write/read tokens and cost (when a prefix is used)
   ✓ Cache hit/miss information
   ✓ Total cost per request
   ✓ Running total cost for the session
@@ -28,9 +51,12 @@ Log Output Includes:
 Environment Variables:
   - ANTHROPIC_TOKEN_PRICING: Override default pricing (JSON string)
   - LOG_TOKEN_COSTS: Enable/disable cost logging (default: True)
+  - LLM_LOG_LEVEL: Level for the llm_calls log; WARNING keeps only problems (default: INFO)
+  - LLM_CACHE_TTL_SECONDS: Age after which cached responses expire (default: 604800, 7 days)
+  - LLM_CACHE_MAX_ENTRIES: Max cached responses, least recently used evicted first (default: 10000)
 
 Example:
-  export ANTHROPIC_TOKEN_PRICING='{"input": 1.0, "output": 5.0, "thinking": 0.5}'
+  export ANTHROPIC_TOKEN_PRICING='{"input": 1.0, "output": 5.0}'
   export LOG_TOKEN_COSTS=True
   python main.py
 """
@@ -42,18 +68,114 @@ log_file = os.path.join(
     log_directory, f"llm_calls_{datetime.now().strftime('%Y%m%d')}.log"
 )
 
+class _BufferedFileHandler(logging.FileHandler):
+    """FileHandler that writes through a 64 KiB buffer and only flushes on WARNING and above."""
+    
+    buffer_size = 65536
+    
+    def _open(self):
+        return open(
+            self.baseFilename, self.mode, buffering=self.buffer_size,
+            encoding=self.encoding, errors=self.errors
+        )
+    
+    def emit(self, record):
+        # Same as StreamHandler.emit, minus the flush after every record
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+            if record.levelno >= logging.WARNING:
+                self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+class _CachedTimeFormatter(logging.Formatter):
+    """Formatter that reuses the formatted timestamp for all records within the same second."""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cached_second = None
+        self._cached_time = ""
+    
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        if second != self._cached_second:
+            self._cached_time = time.strftime(
+                datefmt or self.default_time_format, self.converter(second)
+            )
+            self._cached_second = second
+        if datefmt:
+            return self._cached_time
+        return self.default_msec_format % (self._cached_time, record.msecs)
+
 # Set up logger
 logger = logging.getLogger("llm_logger")
-logger.setLevel(logging.INFO)
+
+def _log_level_from_env() -> int:
+    """Parse LLM_LOG_LEVEL as a level name or number, falling back to INFO."""
+    value = os.getenv("LLM_LOG_LEVEL", "").strip() or "INFO"
+    if value.isdigit():
+        return int(value)
+    level = logging.getLevelName(value.upper())
+    if isinstance(level, int):
+        return level
+    logger.warning(f"Unknown LLM_LOG_LEVEL {value!r}; using INFO")
+    return logging.INFO
+
 logger.propagate = False  # Prevent propagation to root logger
-file_handler = logging.FileHandler(log_file, encoding='utf-8')
+# Buffered records are flushed when the handler is closed by logging.shutdown() at exit
+file_handler = _BufferedFileHandler(log_file, encoding='utf-8')
 file_handler.setFormatter(
-    logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    _CachedTimeFormatter("%(asctime)s - %(levelname)s - %(message)s")
 )
-logger.addHandler(file_handler)
+
+# Callers only enqueue records; a background listener thread does the file I/O
+_log_queue = queue.Queue(-1)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, file_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+# e.g. WARNING to skip prompt/response and token cost records entirely
+logger.setLevel(_log_level_from_env())
+
+
+def _trunc(s: str, n: int = 200) -> str:
+    """Shorten s to n characters for log output."""
+    return s if len(s) <= n else s[:n] + "..."
 
 # Simple cache configuration
-cache_file = "llm_cache.json"
+# The cache is a SQLite table (WAL mode, safe across concurrent processes).
+# Entries are keyed by a 16-byte BLAKE2b digest of the request settings and prompt (see _cache_key).
+# A pre-SQLite llm_cache.json ({prompt: response}) is imported once on first use.
+# Entries expire after LLM_CACHE_TTL_SECONDS, and the least recently used ones are
+# evicted beyond LLM_CACHE_MAX_ENTRIES (0 disables either limit).
+cache_file = "llm_cache.db"
+legacy_cache_file = "llm_cache.json"
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+_cache_db = None
+_cache_size = 0  # Row count as last seen by this process, so misses don't re-count the table
+_CACHE_LOCK = threading.Lock()
+# New responses are buffered and committed by a background writer thread every
+# _CACHE_FLUSH_SECONDS, as soon as _CACHE_FLUSH_ENTRIES are pending, and at exit (see flush_cache)
+_CACHE_FLUSH_ENTRIES = 32
+_CACHE_FLUSH_SECONDS = 5.0
+_pending_writes: dict[bytes, tuple] = {}  # key -> (response, model, ts)
+_pending_embeddings: list[tuple] = []  # (key, model, settings, embedder, embedding bytes)
+_flushing_writes: dict[bytes, tuple] = {}  # Batch flush_cache() is committing, still served by _cache_get
+# Commits use their own connection under their own lock, so a writer waiting on another
+# process's write lock never holds up lookups. Taken before, never while holding, _CACHE_LOCK.
+_cache_write_db = None
+_CACHE_WRITE_LOCK = threading.Lock()
+_cache_writer_thread = None
+_cache_writer_wakeup = threading.Event()
+# Small in-process LRU in front of the database, so repeated prompts never touch disk
+_MEM_CACHE_MAX = 1024
+_mem_cache: OrderedDict[bytes, tuple] = OrderedDict()  # key -> (response, ts), ts as in the cache table
+_mem_hits: set[bytes] = set()  # Keys read since the last flush, whose last_used it refreshes on disk
 
 # Token pricing configuration (in USD per 1M tokens)
 # Updated for Claude models: https://www.anthropic.com/pricing
@@ -61,43 +183,86 @@ TOKEN_PRICING = {
     "claude-haiku-4-5-20251001": {
         "input": 0.80,           # $0.80 per 1M input tokens
         "output": 4.00,          # $4.00 per 1M output tokens
-        "thinking": 0.30,        # $0.30 per 1M thinking tokens (cheaper than input)
+        "cache_write": 1.00,     # $1.00 per 1M tokens written to the prompt cache (1.25x input)
+        "cache_read": 0.08,      # $0.08 per 1M tokens read from the prompt cache (0.1x input)
     },
     "claude-3-5-sonnet-20241022": {
         "input": 3.00,
         "output": 15.00,
-        "thinking": 1.00,
+        "cache_write": 3.75,
+        "cache_read": 0.30,
     },
     "claude-3-opus-20250219": {
         "input": 15.00,
         "output": 75.00,
-        "thinking": 5.00,
+        "cache_write": 18.75,
+        "cache_read": 1.50,
     }
 }
 
 # Global variable to track cumulative costs
 _session_total_cost = 0.0
+_COST_LOCK = threading.Lock()  # call_llm_batch logs costs from several threads at once
+
+# Resolved once at import rather than on every call
+_LOG_TOKEN_COSTS = os.getenv("LOG_TOKEN_COSTS", "True").lower() in ("true", "1", "yes")
 
 def _load_token_pricing():
     """Load token pricing from environment or use defaults."""
     env_pricing = os.getenv("ANTHROPIC_TOKEN_PRICING", "")
     if env_pricing:
         try:
-            custom_pricing = json.loads(env_pricing)
+            custom_pricing = _json_loads(env_pricing)
             return custom_pricing
         except json.JSONDecodeError as e:
             logger.warning(f"Failed to parse ANTHROPIC_TOKEN_PRICING: {e}. Using defaults.")
     return TOKEN_PRICING
 
-def _calculate_token_cost(model: str, input_tokens: int, output_tokens: int, thinking_tokens: int = 0) -> dict:
+def _per_token_prices(model_pricing: dict) -> dict:
+    """
+    Convert per-1M-token prices into per-token prices, filling in haiku defaults.
+    
+    Prompt cache prices default to Anthropic's multiples of the input price.
+    """
+    input_price = model_pricing.get("input", 0.80)
+    return {
+        "input": input_price / 1_000_000,
+        "output": model_pricing.get("output", 4.00) / 1_000_000,
+        "cache_write": model_pricing.get("cache_write", input_price * 1.25) / 1_000_000,
+        "cache_read": model_pricing.get("cache_read", input_price * 0.1) / 1_000_000,
+    }
+
+# Per-token prices, resolved once at import (see refresh_pricing)
+_PRICING_PER_TOKEN: dict[str, dict] = {}
+_DEFAULT_PRICING_PER_TOKEN: dict = {}
+
+def refresh_pricing():
+    """Re-read token pricing, e.g. after changing ANTHROPIC_TOKEN_PRICING in tests."""
+    global _PRICING_PER_TOKEN, _DEFAULT_PRICING_PER_TOKEN
+    
+    _PRICING_PER_TOKEN = {
+        model: _per_token_prices(model_pricing)
+        for model, model_pricing in _load_token_pricing().items()
+        if isinstance(model_pricing, dict)
+    }
+    # Unknown models fall back to haiku pricing
+    _DEFAULT_PRICING_PER_TOKEN = (
+        _PRICING_PER_TOKEN.get("claude-haiku-4-5-20251001") or _per_token_prices({})
+    )
+
+refresh_pricing()
+
+def _calculate_token_cost(model: str, input_tokens: int, output_tokens: int,
+                          cache_write_tokens: int = 0, cache_read_tokens: int = 0) -> dict:
     """
     Calculate the cost of an LLM API call based on token usage.
     
     Args:
         model: Model name (e.g., "claude-haiku-4-5-20251001")
-        input_tokens: Number of input tokens
-        output_tokens: Number of output tokens
-        thinking_tokens: Number of thinking tokens (if applicable)
+        input_tokens: Number of uncached input tokens
+        output_tokens: Number of output tokens, including any thinking tokens
+        cache_write_tokens: Number of input tokens written to the prompt cache
+        cache_read_tokens: Number of input tokens read from the prompt cache
     
     Returns:
         Dictionary with cost breakdown:
@@ -106,36 +271,48 @@ def _calculate_token_cost(model: str, input_tokens: int, output_tokens: int, thi
             "input_cost": float,
             "output_tokens": int,
             "output_cost": float,
-            "thinking_tokens": int,
-            "thinking_cost": float,
+            "cache_write_tokens": int,
+            "cache_write_cost": float,
+            "cache_read_tokens": int,
+            "cache_read_cost": float,
             "total_tokens": int,
             "total_cost": float
         }
     """
-    pricing = _load_token_pricing()
-    
-    # Get pricing for the model, fall back to haiku if not found
-    model_pricing = pricing.get(model, pricing.get("claude-haiku-4-5-20251001", {}))
+    prices = _PRICING_PER_TOKEN.get(model, _DEFAULT_PRICING_PER_TOKEN)
     
-    input_price = model_pricing.get("input", 0.80) / 1_000_000
-    output_price = model_pricing.get("output", 4.00) / 1_000_000
-    thinking_price = model_pricing.get("thinking", 0.30) / 1_000_000
-    
-    input_cost = input_tokens * input_price
-    output_cost = output_tokens * output_price
-    thinking_cost = thinking_tokens * thinking_price
+    input_cost = input_tokens * prices["input"]
+    output_cost = output_tokens * prices["output"]
+    cache_write_cost = cache_write_tokens * prices["cache_write"]
+    cache_read_cost = cache_read_tokens * prices["cache_read"]
     
     return {
         "input_tokens": input_tokens,
         "input_cost": input_cost,
         "output_tokens": output_tokens,
         "output_cost": output_cost,
-        "thinking_tokens": thinking_tokens,
-        "thinking_cost": thinking_cost,
-        "total_tokens": input_tokens + output_tokens + thinking_tokens,
-        "total_cost": input_cost + output_cost + thinking_cost
+        "cache_write_tokens": cache_write_tokens,
+        "cache_write_cost": cache_write_cost,
+        "cache_read_tokens": cache_read_tokens,
+        "cache_read_cost": cache_read_cost,
+        "total_tokens": input_tokens + output_tokens + cache_write_tokens + cache_read_tokens,
+        "total_cost": input_cost + output_cost + cache_write_cost + cache_read_cost
     }
 
+# Token cost log templates, filled from a _calculate_token_cost() result
+_TOKEN_COST_FMT = (
+    "TOKEN COST:\n"
+    "  MODEL: {model}\n"
+    "  INPUT:    {input_tokens:,} tokens → ${input_cost:.6f}\n"
+    "  OUTPUT:   {output_tokens:,} tokens → ${output_cost:.6f}\n"
+    "{cache_write_line}"
+    "{cache_read_line}"
+    "  TOTAL:    {total_tokens:,} tokens → ${total_cost:.6f}\n"
+    "  SESSION TOTAL: ${session_total_cost:.6f}"
+)
+_CACHE_WRITE_COST_FMT = "  CACHE WRITE: {cache_write_tokens:,} tokens → ${cache_write_cost:.6f}\n"
+_CACHE_READ_COST_FMT = "  CACHE READ:  {cache_read_tokens:,} tokens → ${cache_read_cost:.6f}\n"
+
 def _log_token_cost(cost_info: dict, model: str, from_cache: bool = False):
     """
     Log token usage and cost information.
@@ -147,43 +324,490 @@ def _log_token_cost(cost_info: dict, model: str, from_cache: bool = False):
     """
     global _session_total_cost
     
-    should_log = os.getenv("LOG_TOKEN_COSTS", "True").lower() in ("true", "1", "yes")
-    if not should_log:
+    if not _LOG_TOKEN_COSTS:
         return
     
-    _session_total_cost += cost_info["total_cost"]
-    
     if from_cache:
         logger.info("CACHE HIT - No tokens used")
         return
     
+    with _COST_LOCK:
+        _session_total_cost += cost_info["total_cost"]
+        session_total_cost = _session_total_cost
+    
+    # Skip building the message when INFO records would be dropped anyway
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    
     # Build cost log message
-    cost_lines = [
-        f"MODEL: {model}",
-        f"INPUT:    {cost_info['input_tokens']:,} tokens → ${cost_info['input_cost']:.6f}",
-        f"OUTPUT:   {cost_info['output_tokens']:,} tokens → ${cost_info['output_cost']:.6f}",
-    ]
+    cache_write_line = _CACHE_WRITE_COST_FMT.format_map(cost_info) if cost_info["cache_write_tokens"] > 0 else ""
+    cache_read_line = _CACHE_READ_COST_FMT.format_map(cost_info) if cost_info["cache_read_tokens"] > 0 else ""
+    logger.info(_TOKEN_COST_FMT.format_map({
+        **cost_info,
+        "model": model,
+        "cache_write_line": cache_write_line,
+        "cache_read_line": cache_read_line,
+        "session_total_cost": session_total_cost,
+    }))
+
+def _cache_key(prompt: str, request_kwargs: dict) -> bytes:
+    """
+    Return the fixed-size cache key for a prompt sent with the given request settings.
+    
+    The key covers the model, so switching ANTHROPIC_MODEL never serves another
+    model's response; max_tokens and the thinking budget, so changing them
+    invalidates responses generated under the old limits; and the sampling
+    temperature (None means the API default), so requests sampled differently
+    get their own entries.
+    """
+    key_material = _request_settings(request_kwargs) + "\0" + prompt
+    return hashlib.blake2b(key_material.encode("utf-8"), digest_size=16).digest()
+
+def _request_settings(request_kwargs: dict) -> str:
+    """Return the request settings that _cache_key covers, as a string."""
+    return "\0".join((
+        request_kwargs["model"],
+        str(request_kwargs["max_tokens"]),
+        str(request_kwargs["thinking"]["budget_tokens"]),
+        str(request_kwargs.get("temperature")),
+    ))
+
+def _get_cache_db():
+    """
+    Return the cache database connection, opening it on first use. Call with _CACHE_LOCK held.
+    
+    Raises sqlite3.Error or OSError if the database can't be opened.
+    """
+    global _cache_db, _cache_size
+    
+    if _cache_db is None:
+        try:
+            conn = _open_cache_db()
+        except sqlite3.OperationalError:
+            # Locked or unwritable, not damaged
+            raise
+        except sqlite3.DatabaseError as e:
+            # A damaged file would otherwise fail every lookup; set it aside and start fresh
+            logger.warning(f"Cache database {cache_file} is unreadable ({e}); moving it to {cache_file}.corrupt")
+            try:
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(cache_file + suffix):
+                        os.replace(cache_file + suffix, cache_file + ".corrupt" + suffix)
+            except OSError as move_error:
+                # e.g. a read-only directory; callers treat OSError like any other cache failure
+                logger.warning(f"Failed to move {cache_file} aside: {move_error}")
+                raise
+            conn = _open_cache_db()
+        if os.path.exists(legacy_cache_file):
+            _migrate_legacy_cache(conn)
+        (_cache_size,) = conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+        _cache_db = conn
+    return _cache_db
+
+def _open_cache_db():
+    """Open the cache database, creating or upgrading its schema and purging expired entries."""
+    conn = sqlite3.connect(cache_file, isolation_level=None, check_same_thread=False)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache("
+            "key BLOB PRIMARY KEY, response TEXT, model TEXT, ts INTEGER, last_used INTEGER)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache(last_used)")
+        # Prompt embeddings for the semantic cache, pointing at the cache entry they answer
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS semantic("
+            "key BLOB PRIMARY KEY, model TEXT, settings TEXT, embedder TEXT, embedding BLOB)"
+        )
+        if LLM_CACHE_TTL_SECONDS > 0:
+            conn.execute("DELETE FROM cache WHERE ts < ?", (_cache_cutoff(),))
+        conn.execute("DELETE FROM semantic WHERE key NOT IN (SELECT key FROM cache)")
+    except sqlite3.DatabaseError:
+        conn.close()
+        raise
+    return conn
+
+def _migrate_legacy_cache(conn):
+    """
+    Import the old JSON cache file into the database, then rename it so this runs once.
+    
+    The file does not record which settings produced each response, so entries are
+    keyed under the current request settings.
+    """
+    try:
+        with open(legacy_cache_file, "rb") as f:
+            legacy_cache = _json_loads(f.read())
+        
+        model = _CREATE_KWARGS["model"]
+        now = int(time.time())
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT OR IGNORE INTO cache(key, response, model, ts, last_used) VALUES (?, ?, ?, ?, ?)",
+            (
+                (_cache_key(prompt, _CREATE_KWARGS), response_text, model, now, now)
+                for prompt, response_text in legacy_cache.items()
+            )
+        )
+        conn.execute("COMMIT")
+        os.replace(legacy_cache_file, legacy_cache_file + ".migrated")
+        logger.info(f"Migrated {len(legacy_cache)} entries from {legacy_cache_file} to {cache_file}")
+    except Exception as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        logger.warning(f"Failed to migrate {legacy_cache_file}: {e}")
+
+def _cache_cutoff() -> int:
+    """Return the creation time before which cache entries have expired."""
+    if LLM_CACHE_TTL_SECONDS <= 0:
+        return 0
+    return int(time.time()) - LLM_CACHE_TTL_SECONDS
+
+def _remember(key: bytes, response_text: str, ts: int):
+    """Add a response created at ts to the in-process LRU. Call with _CACHE_LOCK held."""
+    _mem_cache[key] = (response_text, ts)
+    _mem_cache.move_to_end(key)
+    if len(_mem_cache) > _MEM_CACHE_MAX:
+        _mem_cache.popitem(last=False)
+
+def _cache_get(key: bytes):
+    """Return the cached response for a key, or None if it is not cached or has expired."""
+    try:
+        with _CACHE_LOCK:
+            entry = _mem_cache.get(key)
+            if entry is not None:
+                if entry[1] >= _cache_cutoff():
+                    _mem_cache.move_to_end(key)
+                    _mem_hits.add(key)
+                    return entry[0]
+                # Expired while held in memory; the database lookup below skips it too
+                del _mem_cache[key]
+            pending = _pending_writes.get(key) or _flushing_writes.get(key)
+            if pending is not None:
+                return pending[0]
+            db = _get_cache_db()
+            row = db.execute(
+                "SELECT response, ts FROM cache WHERE key = ? AND ts >= ?", (key, _cache_cutoff())
+            ).fetchone()
+            if row:
+                # Recency is written by the background flush, keeping this a read-only lookup
+                _remember(key, row[0], row[1])
+                _mem_hits.add(key)
+                _start_cache_writer()
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"Failed to read cache: {e}")
+        return None
+    return row[0] if row else None
+
+def _cache_put(key: bytes, response_text: str, model: str):
+    """Buffer a response for the background writer to commit to the cache."""
+    with _CACHE_LOCK:
+        now = int(time.time())
+        _remember(key, response_text, now)
+        _pending_writes[key] = (response_text, model, now)
+        
+        _start_cache_writer()
+        if len(_pending_writes) >= _CACHE_FLUSH_ENTRIES:
+            _cache_writer_wakeup.set()
+
+def _start_cache_writer():
+    """Start the background writer thread if it isn't running. Call with _CACHE_LOCK held."""
+    global _cache_writer_thread
+    
+    if _cache_writer_thread is None:
+        _cache_writer_thread = threading.Thread(
+            target=_cache_writer, name="llm-cache-writer", daemon=True
+        )
+        _cache_writer_thread.start()
+
+def _cache_writer():
+    """Background thread: commit buffered cache entries periodically, or sooner when woken."""
+    while True:
+        _cache_writer_wakeup.wait(_CACHE_FLUSH_SECONDS)
+        _cache_writer_wakeup.clear()
+        try:
+            flush_cache()
+        except Exception as e:
+            logger.warning(f"Failed to save cache: {e}")
+
+def _get_cache_write_db():
+    """Return the connection commits are made on, opening it on first use. Call with _CACHE_WRITE_LOCK held."""
+    global _cache_write_db
+    
+    if _cache_write_db is None:
+        with _CACHE_LOCK:
+            # Opens the database, creating its schema, on first use
+            _get_cache_db()
+        conn = sqlite3.connect(cache_file, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _cache_write_db = conn
+    return _cache_write_db
+
+def _commit_cache_batch(writes: dict, hits: set, embeddings: list):
+    """
+    Commit a batch of buffered responses, last_used refreshes and embeddings in one
+    transaction, evicting least recently used entries over the size cap.
+    Call with _CACHE_WRITE_LOCK held.
+    """
+    global _cache_size
+    
+    now = int(time.time())
+    db = _get_cache_write_db()
+    db.execute("BEGIN")
+    try:
+        db.executemany(
+            "INSERT OR REPLACE INTO cache(key, response, model, ts, last_used) VALUES (?, ?, ?, ?, ?)",
+            [(key, response_text, model, ts, ts) for key, (response_text, model, ts) in writes.items()]
+        )
+        # Keep disk recency in step with hits served since the last flush
+        db.executemany(
+            "UPDATE cache SET last_used = ? WHERE key = ?", [(now, key) for key in hits]
+        )
+        db.executemany(
+            "INSERT OR REPLACE INTO semantic(key, model, settings, embedder, embedding) VALUES (?, ?, ?, ?, ?)",
+            embeddings
+        )
+        db.execute("COMMIT")
+    except BaseException:
+        if db.in_transaction:
+            db.execute("ROLLBACK")
+        raise
+    _cache_size += len(writes)
+    
+    if LLM_CACHE_MAX_ENTRIES > 0 and _cache_size > LLM_CACHE_MAX_ENTRIES:
+        # Re-count only when over the cap, since other processes may share the database
+        (count,) = db.execute("SELECT COUNT(*) FROM cache").fetchone()
+        if count > LLM_CACHE_MAX_ENTRIES:
+            # Evict down to 90% of the cap so this runs once per batch of inserts
+            keep = LLM_CACHE_MAX_ENTRIES * 9 // 10
+            db.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY last_used LIMIT ?)",
+                (count - keep,)
+            )
+            count = keep
+        _cache_size = count
+
+def flush_cache():
+    """Commit any buffered cache entries to disk now. Runs automatically at exit."""
+    global _pending_writes, _mem_hits, _pending_embeddings, _flushing_writes
+    
+    with _CACHE_WRITE_LOCK:
+        # Take the buffered batch, leaving fresh buffers for calls made during the commit
+        with _CACHE_LOCK:
+            if not _pending_writes and not _mem_hits and not _pending_embeddings:
+                return
+            writes, hits, embeddings = _pending_writes, _mem_hits, _pending_embeddings
+            _pending_writes, _mem_hits, _pending_embeddings = {}, set(), []
+            _flushing_writes = writes
+        
+        try:
+            _commit_cache_batch(writes, hits, embeddings)
+        except Exception as e:
+            logger.warning(f"Failed to save cache: {e}")
+            # Keep the batch for the next flush; anything buffered since is newer and wins
+            with _CACHE_LOCK:
+                writes.update(_pending_writes)
+                _pending_writes = writes
+                _mem_hits |= hits
+                _pending_embeddings = embeddings + _pending_embeddings
+        finally:
+            with _CACHE_LOCK:
+                _flushing_writes = {}
+
+atexit.register(flush_cache)
+
+def _exit_on_sigterm(signum, frame):
+    # Turn SIGTERM into a normal exit so atexit handlers (flush_cache) still run
+    sys.exit(128 + signum)
+
+if (threading.current_thread() is threading.main_thread()
+        and signal.getsignal(signal.SIGTERM) is signal.SIG_DFL):
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+
+# Optional semantic cache: serves near-duplicate prompts by embedding similarity.
+# Needs numpy and sentence-transformers. Embeddings are persisted in the cache database
+# and point at a cache entry, so semantic hits follow the same TTL and LRU eviction.
+# Like exact hits, they only come from requests with the same model and limits.
+_SEMANTIC_CACHE_ENABLED = os.getenv("LLM_SEMANTIC_CACHE", "0").lower() in ("true", "1", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_MODEL = os.getenv("SEMANTIC_CACHE_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+_semantic_model = None
+
+class _SemanticIndex:
+    """L2-normalised prompt embeddings and the cache keys they point at, one row per key."""
+    
+    def __init__(self, dim: int):
+        import numpy as np
+        
+        # Grown by doubling, so building an index of N rows copies O(N) data in total
+        self._embeddings = np.empty((64, dim), dtype=np.float32)
+        self._keys: list[bytes] = []
+        self._rows: dict[bytes, int] = {}
+    
+    def add(self, cache_key: bytes, embedding):
+        """Add an embedding, replacing the one already stored for cache_key."""
+        import numpy as np
+        
+        row = self._rows.get(cache_key)
+        if row is None:
+            row = len(self._keys)
+            if row == len(self._embeddings):
+                grown = np.empty((2 * row, self._embeddings.shape[1]), dtype=np.float32)
+                grown[:row] = self._embeddings
+                self._embeddings = grown
+            self._keys.append(cache_key)
+            self._rows[cache_key] = row
+        self._embeddings[row] = embedding
+    
+    def remove(self, cache_key: bytes):
+        """Drop the row for cache_key, moving the last row into its place."""
+        row = self._rows.pop(cache_key, None)
+        if row is None:
+            return
+        last_key = self._keys.pop()
+        if last_key != cache_key:
+            self._embeddings[row] = self._embeddings[len(self._keys)]
+            self._keys[row] = last_key
+            self._rows[last_key] = row
     
-    if cost_info['thinking_tokens'] > 0:
-        cost_lines.append(f"THINKING: {cost_info['thinking_tokens']:,} tokens → ${cost_info['thinking_cost']:.6f}")
+    def matches(self, embedding, threshold: float) -> list[tuple[float, bytes]]:
+        """Return (similarity, cache_key) for rows at or above threshold, most similar first."""
+        import numpy as np
+        
+        # Rows and query are normalised, so the dot product is the cosine similarity
+        similarities = self._embeddings[:len(self._keys)] @ embedding
+        candidates = np.flatnonzero(similarities >= threshold)
+        candidates = candidates[np.argsort(-similarities[candidates])]
+        return [(float(similarities[row]), self._keys[row]) for row in candidates]
+
+# Per request settings (see _request_settings)
+_semantic_indexes: dict[str, _SemanticIndex] = {}
+_semantic_loaded = False
+_SEMANTIC_LOCK = threading.Lock()
+
+def _embed_prompt(prompt: str):
+    """
+    Return the L2-normalised embedding of a prompt, loading the model on first use.
     
-    cost_lines.extend([
-        f"TOTAL:    {cost_info['total_tokens']:,} tokens → ${cost_info['total_cost']:.6f}",
-        f"SESSION TOTAL: ${_session_total_cost:.6f}"
-    ])
+    Returns None for prompts longer than the model's max_seq_length. The model would
+    silently embed only their opening tokens, which in this project's prompts are
+    mostly shared template, so prompts differing further on would look identical.
+    """
+    global _semantic_model
     
-    logger.info("TOKEN COST:\n  " + "\n  ".join(cost_lines))
+    with _SEMANTIC_LOCK:
+        if _semantic_model is None:
+            from sentence_transformers import SentenceTransformer
+            _semantic_model = SentenceTransformer(SEMANTIC_CACHE_MODEL)
+    max_length = _semantic_model.max_seq_length
+    # Every word is at least one token, so long prompts are rejected without tokenizing
+    if len(prompt.split()) > max_length:
+        return None
+    if len(_semantic_model.tokenizer(prompt, verbose=False)["input_ids"]) > max_length:
+        return None
+    return _semantic_model.encode(prompt, normalize_embeddings=True).astype("float32")
+
+def _load_semantic_index():
+    """Load persisted embeddings for the current embedding model. Call with _SEMANTIC_LOCK held."""
+    global _semantic_loaded
+    
+    import numpy as np
+    
+    if _semantic_loaded:
+        return
+    _semantic_loaded = True
+    
+    try:
+        with _CACHE_LOCK:
+            rows = _get_cache_db().execute(
+                "SELECT key, settings, embedding FROM semantic WHERE embedder = ?",
+                (SEMANTIC_CACHE_MODEL,)
+            ).fetchall()
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"Failed to load semantic cache: {e}")
+        return
+    
+    for key, settings, embedding in rows:
+        embedding = np.frombuffer(embedding, dtype=np.float32)
+        index = _semantic_indexes.get(settings)
+        if index is None:
+            index = _semantic_indexes[settings] = _SemanticIndex(len(embedding))
+        index.add(key, embedding)
+
+def _semantic_lookup(prompt: str, request_kwargs: dict):
+    """
+    Look up a cached response for a near-duplicate prompt.
+    
+    Args:
+        prompt: The input prompt
+        request_kwargs: Request settings; only responses generated with the same
+            settings (see _request_settings) are considered
+    
+    Returns:
+        (response, embedding) where response is None on a miss, and embedding is
+        the prompt embedding to pass to _semantic_add() (None if unavailable)
+    """
+    global _SEMANTIC_CACHE_ENABLED
+    
+    try:
+        embedding = _embed_prompt(prompt)
+    except ImportError as e:
+        logger.warning(f"Semantic cache disabled, missing dependency: {e}")
+        _SEMANTIC_CACHE_ENABLED = False
+        return None, None
+    except Exception as e:
+        # e.g. the model can't be downloaded; an opt-in cache layer must never fail the call
+        logger.warning(f"Semantic cache disabled, embedding failed: {e}")
+        _SEMANTIC_CACHE_ENABLED = False
+        return None, None
+    if embedding is None:
+        return None, None
+    
+    settings = _request_settings(request_kwargs)
+    with _SEMANTIC_LOCK:
+        _load_semantic_index()
+        index = _semantic_indexes.get(settings)
+        if index is None:
+            return None, embedding
+        for similarity, key in index.matches(embedding, SEMANTIC_CACHE_THRESHOLD):
+            response_text = _cache_get(key)
+            if response_text is not None:
+                logger.info("RESPONSE: (from semantic cache, similarity %.3f)", similarity)
+                return response_text, embedding
+            # The entry has expired or been evicted; drop it so the next best match can answer
+            index.remove(key)
+    return None, embedding
+
+def _semantic_add(embedding, cache_key: bytes, request_kwargs: dict):
+    """Add a prompt embedding to the semantic cache, pointing at the cache entry for its response."""
+    settings = _request_settings(request_kwargs)
+    with _SEMANTIC_LOCK:
+        index = _semantic_indexes.get(settings)
+        if index is None:
+            index = _semantic_indexes[settings] = _SemanticIndex(len(embedding))
+        index.add(cache_key, embedding)
+        with _CACHE_LOCK:
+            _pending_embeddings.append(
+                (cache_key, request_kwargs["model"], settings, SEMANTIC_CACHE_MODEL, embedding.tobytes())
+            )
 
 """
 === LLM OPTIMIZATION GUIDE ===
 
 CURRENT SETUP: Anthropic Claude Haiku with Extended Thinking
 
-Configuration via Environment Variables:
+Configuration via Environment Variables (read once at import):
   - ANTHROPIC_API_KEY:           Your API key (required)
   - ANTHROPIC_MODEL:             Model name (default: claude-haiku-4-5-20251001)
   - ANTHROPIC_MAX_TOKENS:        Max output tokens (default: 8000)
   - ANTHROPIC_THINKING_BUDGET:   Max thinking tokens (default: 5000)
+  - ANTHROPIC_STREAMING:         Stream responses; False falls back to messages.create (default: True)
+  - LLM_SEMANTIC_CACHE:          Also serve near-duplicate prompts from cache (default: 0)
+  - SEMANTIC_CACHE_THRESHOLD:    Min cosine similarity for a semantic hit (default: 0.92)
+  - SEMANTIC_CACHE_MODEL:        sentence-transformers embedding model; prompts longer than
+                                 its max_seq_length only use the exact cache
+                                 (default: sentence-transformers/all-MiniLM-L6-v2)
 
 OPTIMIZATION RATIONALE:
   ✓ Reduced thinking_budget from 20,000 → 5,000
@@ -331,7 +955,237 @@ Example Usage:
 # Use Anthropic Claude 3.7 Sonnet Extended Thinking
 # claude-haiku-4-5-20251001 
 
-def call_llm(prompt, use_cache: bool = True):
+def _check_cache(prompt: str):
+    """
+    Look up a prompt in the exact cache and, if enabled, the semantic cache.
+    
+    Args:
+        prompt: The input prompt
+    
+    Returns:
+        (cached_response, cache_key, prompt_embedding). cached_response is None
+        on a miss; cache_key and prompt_embedding are then passed on to
+        _process_response() so the new response can be cached.
+    """
+    cache_key = _cache_key(prompt, _CREATE_KWARGS)
+    cached_response = _cache_get(cache_key)
+    if cached_response is not None:
+        logger.info("RESPONSE: (from cache)")
+        _log_token_cost({}, "", from_cache=True)
+        return cached_response, cache_key, None
+    
+    prompt_embedding = None
+    if _SEMANTIC_CACHE_ENABLED:
+        cached_response, prompt_embedding = _semantic_lookup(prompt, _CREATE_KWARGS)
+        if cached_response is not None:
+            _log_token_cost({}, "", from_cache=True)
+    return cached_response, cache_key, prompt_embedding
+
+# Prompts currently being fetched, so concurrent identical calls share one API request
+_inflight: dict[bytes, tuple[Future, int]] = {}  # key -> (future, owner thread id)
+_INFLIGHT_LOCK = threading.Lock()
+
+def _claim_inflight(cache_key: bytes, blocking: bool = True):
+    """
+    Register interest in a prompt that missed the cache.
+    
+    Args:
+        cache_key: The prompt's cache key
+        blocking: Whether the caller will block its thread on the future. A blocking
+            caller on the owner's own thread (e.g. two interleaved call_llm_stream
+            generators) could never be answered, so it makes its own request instead.
+    
+    Returns:
+        (future, owner). If owner is True the caller makes the request and must
+        resolve the future and then call _release_inflight(); otherwise the
+        future resolves to the owner's response. future is None when the caller
+        should make the request without sharing it.
+    """
+    thread_id = threading.get_ident()
+    with _INFLIGHT_LOCK:
+        entry = _inflight.get(cache_key)
+        if entry is not None:
+            future, owner_thread = entry
+            if blocking and owner_thread == thread_id:
+                return None, True
+            return future, False
+        future = Future()
+        # A running future can't be cancelled, so a waiter giving up never fails the owner
+        future.set_running_or_notify_cancel()
+        _inflight[cache_key] = (future, thread_id)
+        return future, True
+
+def _release_inflight(cache_key: bytes):
+    """Forget a finished in-flight request."""
+    with _INFLIGHT_LOCK:
+        _inflight.pop(cache_key, None)
+
+def _require_api_key() -> str:
+    """Return ANTHROPIC_API_KEY, raising ValueError if it is not set."""
+    api_key = os.environ.get("ANTHROPIC_API_KEY", "")
+    if not api_key:
+        logger.error("ANTHROPIC_API_KEY not set")
+        raise ValueError("ANTHROPIC_API_KEY environment variable not set")
+    return api_key
+
+# API clients are created once and reused so their HTTP connection pools persist across calls
+_client = None
+_async_client = None
+_async_client_loop = None
+_CLIENT_LOCK = threading.Lock()
+
+def _get_client():
+    """Return the shared Anthropic client, creating it on first use."""
+    global _client
+    
+    from anthropic import Anthropic
+    
+    with _CLIENT_LOCK:
+        if _client is None:
+            _client = Anthropic(api_key=_require_api_key())
+        return _client
+
+def _get_async_client():
+    """Return the shared AsyncAnthropic client for the running event loop."""
+    global _async_client, _async_client_loop
+    
+    from anthropic import AsyncAnthropic
+    
+    # An async connection pool is bound to the event loop it was created on
+    loop = asyncio.get_running_loop()
+    with _CLIENT_LOCK:
+        if _async_client is None or _async_client_loop is not loop:
+            _async_client = AsyncAnthropic(api_key=_require_api_key())
+            _async_client_loop = loop
+        return _async_client
+
+# Configurable settings from environment, resolved once at import
+_ANTHROPIC_MODEL = os.getenv("ANTHROPIC_MODEL", "claude-haiku-4-5-20251001")
+_ANTHROPIC_MAX_TOKENS = int(os.getenv("ANTHROPIC_MAX_TOKENS", "8000"))
+_ANTHROPIC_THINKING_BUDGET = int(os.getenv("ANTHROPIC_THINKING_BUDGET", "5000"))
+# Use messages.stream(); set to false for proxies/gateways that don't support streaming
+_ANTHROPIC_STREAMING = os.getenv("ANTHROPIC_STREAMING", "True").lower() in ("true", "1", "yes")
+
+# Prompt-independent messages.create() arguments, built once by reconfigure()
+_CREATE_KWARGS: dict = {}
+
+def reconfigure(model: str = None, max_tokens: int = None, thinking_budget: int = None):
+    """
+    Override the request settings at runtime, e.g. in tests.
+    
+    Args:
+        model: Model name (default: keep current, initially ANTHROPIC_MODEL)
+        max_tokens: Max output tokens (default: keep current, initially ANTHROPIC_MAX_TOKENS)
+        thinking_budget: Max thinking tokens (default: keep current, initially ANTHROPIC_THINKING_BUDGET)
+    """
+    global _ANTHROPIC_MODEL, _ANTHROPIC_MAX_TOKENS, _ANTHROPIC_THINKING_BUDGET, _CREATE_KWARGS
+    
+    if model is not None:
+        _ANTHROPIC_MODEL = model
+    if max_tokens is not None:
+        _ANTHROPIC_MAX_TOKENS = max_tokens
+    if thinking_budget is not None:
+        _ANTHROPIC_THINKING_BUDGET = thinking_budget
+    
+    _CREATE_KWARGS = {
+        "model": _ANTHROPIC_MODEL,
+        "max_tokens": _ANTHROPIC_MAX_TOKENS,
+        "thinking": {
+            "type": "enabled",
+            "budget_tokens": _ANTHROPIC_THINKING_BUDGET
+        },
+    }
+    
+    logger.info(
+        f"LLM settings: model={_ANTHROPIC_MODEL} max_tokens={_ANTHROPIC_MAX_TOKENS} "
+        f"thinking_budget={_ANTHROPIC_THINKING_BUDGET} streaming={_ANTHROPIC_STREAMING}"
+    )
+    # The API rejects these outright, so say so once rather than failing every call
+    if _ANTHROPIC_THINKING_BUDGET < 1024:
+        logger.warning(f"Thinking budget {_ANTHROPIC_THINKING_BUDGET} is below the API minimum of 1024 tokens")
+    if _ANTHROPIC_THINKING_BUDGET >= _ANTHROPIC_MAX_TOKENS:
+        logger.warning(
+            f"Thinking budget {_ANTHROPIC_THINKING_BUDGET} must be less than max_tokens {_ANTHROPIC_MAX_TOKENS}"
+        )
+
+reconfigure()
+
+def _build_request(prompt: str, prefix: str = None) -> dict:
+    """
+    Build the messages.create() arguments for a prompt.
+    
+    A prefix is sent as its own text block marked for Anthropic prompt caching, so
+    requests sharing that prefix reuse it server-side at reduced input cost.
+    """
+    content = prompt
+    if prefix:
+        content = [
+            {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": prompt},
+        ]
+    return {
+        **_CREATE_KWARGS,
+        "messages": [
+            {"role": "user", "content": content}
+        ]
+    }
+
+def _process_response(response, request: dict, use_cache: bool, cache_key, prompt_embedding) -> str:
+    """
+    Extract the text from an API response, log it with its token cost and cache it.
+    
+    Args:
+        response: The messages.create() response
+        request: The messages.create() arguments the response was generated with
+        use_cache: Whether to store the response in the cache
+        cache_key: Cache key returned by _check_cache()
+        prompt_embedding: Prompt embedding returned by _check_cache()
+    
+    Returns:
+        The LLM response text
+    """
+    model = request["model"]
+    
+    # Join every text block, matching what call_llm_stream yields from text_stream
+    text_blocks = [block.text for block in response.content if block.type == "text"]
+    
+    if not text_blocks:
+        error_msg = f"No text content in response. Content types: {[c.type for c in response.content]}"
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+    response_text = "".join(text_blocks)
+    
+    # Log the response
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("RESPONSE: %s", _trunc(response_text))
+    
+    # Extract token usage and calculate cost
+    input_tokens = response.usage.input_tokens
+    output_tokens = response.usage.output_tokens
+    
+    # Prompt cache usage (see prefix), billed separately from input_tokens.
+    # Thinking is billed as output and already counted in output_tokens.
+    cache_write_tokens = getattr(response.usage, 'cache_creation_input_tokens', 0) or 0
+    cache_read_tokens = getattr(response.usage, 'cache_read_input_tokens', 0) or 0
+    
+    cost_info = _calculate_token_cost(
+        model, input_tokens, output_tokens,
+        cache_write_tokens=cache_write_tokens, cache_read_tokens=cache_read_tokens
+    )
+    _log_token_cost(cost_info, model, from_cache=False)
+    
+    # Update cache if enabled
+    if use_cache:
+        try:
+            _cache_put(cache_key, response_text, model)
+            if prompt_embedding is not None:
+                _semantic_add(prompt_embedding, cache_key, request)
+        except Exception as e:
+            logger.warning(f"Failed to save cache: {e}")
+    
+    return response_text
+
+def call_llm(prompt, use_cache: bool = True, prefix: str = None):
     """
     Call Claude Haiku with optimized settings for cost and performance.
     
@@ -342,110 +1196,207 @@ def call_llm(prompt, use_cache: bool = True):
     - Logging for debugging
     - Caching support
     - Token cost tracking
+    - Streamed response, joined once complete (see call_llm_stream)
+    - Optional server-side prompt caching of a shared prefix
     
     Args:
         prompt: The input prompt
         use_cache: Whether to use cache (default: True)
+        prefix: Large context shared across calls (e.g. source files), sent
+            ahead of the prompt and cached server-side (default: None)
     
     Returns:
         The LLM response text
     """
-    from anthropic import Anthropic
+    return "".join(call_llm_stream(prompt, use_cache, prefix))
+
+def call_llm_stream(prompt, use_cache: bool = True, prefix: str = None):
+    """
+    Stream the LLM response text as it is generated.
+    
+    A cached response is yielded as a single chunk, as is the whole response when
+    ANTHROPIC_STREAMING is off. Logging, token cost tracking and caching of a
+    fresh response happen once the stream has completed.
+    
+    Args:
+        prompt: The input prompt
+        use_cache: Whether to use cache (default: True)
+        prefix: Shared context sent ahead of the prompt (see call_llm)
+    
+    Yields:
+        Chunks of the LLM response text
+    """
+    full_prompt = prefix + prompt if prefix else prompt
     
     # Log the prompt
-    logger.info(f"PROMPT: {prompt[:200]}..." if len(prompt) > 200 else f"PROMPT: {prompt}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("PROMPT: %s", _trunc(full_prompt))
     
     # Check cache if enabled
+    cache_key = prompt_embedding = inflight = None
     if use_cache:
-        cache = {}
-        if os.path.exists(cache_file):
-            try:
-                with open(cache_file, "r", encoding="utf-8") as f:
-                    cache = json.load(f)
-                if prompt in cache:
-                    logger.info("RESPONSE: (from cache)")
-                    _log_token_cost({}, "", from_cache=True)
-                    return cache[prompt]
-            except Exception as e:
-                logger.warning(f"Failed to load cache: {e}")
+        cached_response, cache_key, prompt_embedding = _check_cache(full_prompt)
+        if cached_response is not None:
+            yield cached_response
+            return
+        
+        # If another thread is already requesting this prompt, wait for its response
+        inflight, owner = _claim_inflight(cache_key)
+        if not owner:
+            response_text = inflight.result()
+            logger.info("RESPONSE: (shared with in-flight request)")
+            yield response_text
+            return
+        if inflight is not None:
+            # A previous owner may have finished after our cache check; its response is cached by now
+            cached_response = _cache_get(cache_key)
+            if cached_response is not None:
+                inflight.set_result(cached_response)
+                _release_inflight(cache_key)
+                logger.info("RESPONSE: (from cache)")
+                yield cached_response
+                return
     
     try:
-        # Initialize client with API key from environment
-        api_key = os.environ.get("ANTHROPIC_API_KEY", "")
-        if not api_key:
-            logger.error("ANTHROPIC_API_KEY not set")
-            raise ValueError("ANTHROPIC_API_KEY environment variable not set")
-        
-        client = Anthropic(api_key=api_key)
-        
-        # Get configurable settings from environment
-        model = os.getenv("ANTHROPIC_MODEL", "claude-haiku-4-5-20251001")
-        max_tokens = int(os.getenv("ANTHROPIC_MAX_TOKENS", "8000"))
-        thinking_budget = int(os.getenv("ANTHROPIC_THINKING_BUDGET", "5000"))
+        # Reuse the shared client (API key from environment)
+        client = _get_client()
         
         # Make the API call with optimized settings
-        response = client.messages.create(
-            model=model,
-            max_tokens=max_tokens,
-            thinking={
-                "type": "enabled",
-                "budget_tokens": thinking_budget
-            },
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
-        
-        # Safely extract text from response
-        response_text = None
-        for content_block in response.content:
-            if content_block.type == "text":
-                response_text = content_block.text
-                break
-        
-        if response_text is None:
-            error_msg = f"No text content in response. Content types: {[c.type for c in response.content]}"
-            logger.error(error_msg)
-            raise ValueError(error_msg)
-        
-        # Log the response
-        logger.info(f"RESPONSE: {response_text[:200]}..." if len(response_text) > 200 else f"RESPONSE: {response_text}")
+        request = _build_request(prompt, prefix)
+        if _ANTHROPIC_STREAMING:
+            with client.messages.stream(**request) as stream:
+                for text in stream.text_stream:
+                    yield text
+                response = stream.get_final_message()
+        else:
+            response = client.messages.create(**request)
         
-        # Extract token usage and calculate cost
-        input_tokens = response.usage.input_tokens
-        output_tokens = response.usage.output_tokens
+        response_text = _process_response(response, request, use_cache, cache_key, prompt_embedding)
+        if inflight is not None:
+            inflight.set_result(response_text)
+        if not _ANTHROPIC_STREAMING:
+            yield response_text
         
-        # Check if we have thinking tokens (for extended thinking models)
-        thinking_tokens = getattr(response.usage, 'cache_creation_input_tokens', 0) or 0
-        # Note: Anthropic includes thinking in input_tokens, so we don't double-count
-        # But we can extract it if available in the response
+    except Exception as e:
+        if inflight is not None and not inflight.done():
+            inflight.set_exception(e)
+        error_msg = f"LLM API call failed: {str(e)}"
+        logger.error(error_msg)
+        raise
+    finally:
+        if inflight is not None:
+            if not inflight.done():
+                # The caller stopped consuming the stream before it finished
+                inflight.set_exception(RuntimeError("In-flight LLM request was abandoned"))
+            _release_inflight(cache_key)
+
+def call_llm_batch(prompts, use_cache: bool = True, max_workers: int = 8, prefix: str = None):
+    """
+    Call the LLM for many independent prompts in parallel threads.
+    
+    Identical prompts in the batch share a single API request (see _claim_inflight).
+    
+    Args:
+        prompts: Iterable of input prompts
+        use_cache: Whether to use cache (default: True)
+        max_workers: Max number of requests in flight at once (default: 8)
+        prefix: Shared context sent ahead of every prompt (see call_llm)
+    
+    Returns:
+        List of response texts, in the same order as prompts
+    """
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="call_llm") as executor:
+        return list(executor.map(lambda prompt: call_llm(prompt, use_cache, prefix), prompts))
+
+async def call_llm_async(prompt, use_cache: bool = True, prefix: str = None):
+    """
+    Async version of call_llm(), using anthropic.AsyncAnthropic.
+    
+    Shares the cache, in-flight request deduplication, logging and token cost
+    tracking with call_llm(). The cache lookup (SQLite and, if enabled, prompt
+    embedding) runs in a worker thread so it doesn't block the event loop; cache
+    writes are already handed to the background writer thread.
+    
+    Args:
+        prompt: The input prompt
+        use_cache: Whether to use cache (default: True)
+        prefix: Shared context sent ahead of the prompt (see call_llm)
+    
+    Returns:
+        The LLM response text
+    """
+    full_prompt = prefix + prompt if prefix else prompt
+    
+    # Log the prompt
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("PROMPT: %s", _trunc(full_prompt))
+    
+    # Check cache if enabled
+    cache_key = prompt_embedding = inflight = None
+    if use_cache:
+        cached_response, cache_key, prompt_embedding = await asyncio.to_thread(_check_cache, full_prompt)
+        if cached_response is not None:
+            return cached_response
         
-        cost_info = _calculate_token_cost(model, input_tokens, output_tokens, thinking_tokens)
-        _log_token_cost(cost_info, model, from_cache=False)
+        # If another task or thread is already requesting this prompt, wait for its response
+        inflight, owner = _claim_inflight(cache_key, blocking=False)
+        if not owner:
+            # Shielded so a cancelled waiter leaves the shared future to the others
+            response_text = await asyncio.shield(asyncio.wrap_future(inflight))
+            logger.info("RESPONSE: (shared with in-flight request)")
+            return response_text
+        # A previous owner may have finished after our cache check; its response is cached by now
+        cached_response = await asyncio.to_thread(_cache_get, cache_key)
+        if cached_response is not None:
+            inflight.set_result(cached_response)
+            _release_inflight(cache_key)
+            logger.info("RESPONSE: (from cache)")
+            return cached_response
+    
+    try:
+        client = _get_async_client()
         
-        # Update cache if enabled
-        if use_cache:
-            try:
-                cache = {}
-                if os.path.exists(cache_file):
-                    try:
-                        with open(cache_file, "r", encoding="utf-8") as f:
-                            cache = json.load(f)
-                    except:
-                        pass
-                
-                cache[prompt] = response_text
-                with open(cache_file, "w", encoding="utf-8") as f:
-                    json.dump(cache, f, ensure_ascii=False)
-            except Exception as e:
-                logger.warning(f"Failed to save cache: {e}")
+        request = _build_request(prompt, prefix)
+        response = await client.messages.create(**request)
         
+        response_text = _process_response(response, request, use_cache, cache_key, prompt_embedding)
+        if inflight is not None:
+            inflight.set_result(response_text)
         return response_text
         
     except Exception as e:
+        if inflight is not None and not inflight.done():
+            inflight.set_exception(e)
         error_msg = f"LLM API call failed: {str(e)}"
         logger.error(error_msg)
         raise
+    finally:
+        if inflight is not None:
+            if not inflight.done():
+                # The task was cancelled before the response arrived
+                inflight.set_exception(RuntimeError("In-flight LLM request was abandoned"))
+            _release_inflight(cache_key)
+
+async def call_llm_many(prompts, use_cache: bool = True, concurrency: int = 8, prefix: str = None):
+    """
+    Call the LLM for many independent prompts concurrently.
+    
+    Args:
+        prompts: Iterable of input prompts
+        use_cache: Whether to use cache (default: True)
+        concurrency: Max number of requests in flight at once (default: 8)
+        prefix: Shared context sent ahead of every prompt (see call_llm)
+    
+    Returns:
+        List of response texts, in the same order as prompts
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def _call_one(prompt):
+        async with semaphore:
+            return await call_llm_async(prompt, use_cache, prefix)
+    
+    return await asyncio.gather(*(_call_one(prompt) for prompt in prompts))
 
 # # Use OpenAI o1
 # def call_llm(prompt, use_cache: bool = True):